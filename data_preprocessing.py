@@ -1,44 +1,172 @@
+import os
+import shutil
+import hashlib
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+from numba import njit, prange
 from google.colab import drive
 
 # ============================================================
 # 0. 基礎設定
 # ============================================================
 pd.set_option("display.max_columns", None)
-drive.mount('/drive', force_remount=True)
+if not os.path.ismount('/drive'):
+    drive.mount('/drive')
+
+# Drive FUSE 很慢：原始檔複製到 Colab 本機 SSD 處理，中間檔也寫在本機
+LOCAL_DIR = "/content/data"
+os.makedirs(LOCAL_DIR, exist_ok=True)
+
+CSV_BLOCK_SIZE = 64 << 20   # pyarrow 讀 CSV 時每個執行緒處理的區塊大小
+
+# 財務比率欄位
+RATIO_COLS = [
+    "bm","evm","pe_exi","pe_inc","ptb","gprof","gpm","npm",
+    "opmad","roa","roe","cfm","cash_debt","short_debt",
+    "curr_debt","de_ratio","debt_at","quick_ratio",
+    "curr_ratio","rect_turn","at_turn","rd_sale"
+]
+
+# 讀檔 dtype（key 為標準化後欄名）：比率用 float32、代碼用 category、permno 用可空的 Int32
+CRSP_DTYPES = {
+    "permno": "Int32", "prc": np.float32, "ncusip": "category",
+}
+IBES_DTYPES = {
+    "gvkey": np.int32, "permno": "Int32",
+    **{c: np.float32 for c in RATIO_COLS},
+}
+
+# 下游實際用到的欄位（標準化後欄名），其餘欄位不讀入
+CRSP_KEEP = {"permno", "date", "ncusip", "prc"}
+IBES_KEEP = {"gvkey", "permno", "date", *RATIO_COLS}
 
 
 # ============================================================
 # 1. 通用工具：載入 CSV、標準化欄位
 # ============================================================
 
-def load_csv(file_path, encoding="utf-8"):
-    """讀取 CSV + 標準化欄位名稱 + 回傳 DataFrame"""
-    print(f"\n📂 Loading file: {file_path}")
-
+def _normalize_column(col):
+    """CSV 原始欄名 → 標準化欄名（小寫、日期欄統一為 date、gvkey / permno 變體統一）"""
+    col = col.lower().strip()
+    col = {"public_date": "date", "datadate": "date"}.get(col, col)
+    if "gvkey" in col:
+        return "gvkey"
+    if "permno" in col:
+        return "permno"
+    return col
+
+
+def _arrow_type(dtype):
+    """pandas dtype → pyarrow CSV 欄位型別"""
+    if dtype == "category":
+        return pa.dictionary(pa.int32(), pa.string())
+    if dtype == "Int32":
+        return pa.int32()
+    return pa.from_numpy_dtype(dtype)
+
+
+def _csv_to_parquet(file_path, cached, dtypes, keep, encoding):
+    """以 pyarrow 多執行緒讀取 CSV（只解析 keep 欄位、指定型別）並寫成 Parquet（zstd）"""
+    header = pd.read_csv(file_path, encoding=encoding, nrows=0).columns
+    names = {c: _normalize_column(c) for c in header}
+    include = [c for c, n in names.items() if keep is None or n in keep]
+
+    # 日期欄先以字串讀入，稍後以 pandas errors="coerce" 解析（無法解析者為 NaT，不中斷轉檔）
+    date_cols = [c for c, n in names.items() if n == "date" and c in include]
+    column_types = {c: _arrow_type(dtypes[n]) for c, n in names.items() if n in dtypes}
+    column_types.update({c: pa.string() for c in date_cols})
+
+    mtime_ns = os.stat(file_path).st_mtime_ns
+    table = pv.read_csv(
+        file_path,
+        read_options=pv.ReadOptions(use_threads=True, block_size=CSV_BLOCK_SIZE, encoding=encoding),
+        parse_options=pv.ParseOptions(invalid_row_handler=lambda row: "skip"),
+        convert_options=pv.ConvertOptions(column_types=column_types, include_columns=include),
+    )
+    for c in date_cols:
+        dates = pd.to_datetime(table.column(c).to_pandas(), errors="coerce")
+        table = table.set_column(table.schema.get_field_index(c), c, pa.array(dates, pa.timestamp("ns")))
+
+    tmp = cached + ".tmp"
+    pq.write_table(table, tmp, compression="zstd")
+    # 快取檔的 mtime 設為讀取前來源 CSV 的 mtime，之後以此判斷 CSV 是否更新過
+    os.utime(tmp, ns=(mtime_ns, mtime_ns))
+    os.replace(tmp, cached)
+
+
+def _cached_parquet(file_path, dtypes, keep=None, encoding="utf-8"):
+    """回傳 CSV 對應的 Parquet 快取路徑；不存在、CSV 已更新（mtime 不同）或缺少 keep 欄位時重新轉檔"""
+    cached = file_path + ".parquet"
+    if os.path.exists(cached) and os.stat(cached).st_mtime_ns == os.stat(file_path).st_mtime_ns:
+        if keep is None:
+            return cached
+        header = pd.read_csv(file_path, encoding=encoding, nrows=0).columns
+        wanted = {_normalize_column(c) for c in header} & set(keep)
+        if wanted <= {_normalize_column(c) for c in pq.read_schema(cached).names}:
+            return cached
+
+    print(f"🗜️ 建立 Parquet 快取: {cached}")
     try:
-        df = pd.read_csv(file_path, encoding=encoding, on_bad_lines="skip", low_memory=False)
-    except UnicodeDecodeError:
+        _csv_to_parquet(file_path, cached, dtypes, keep, encoding)
+    except (UnicodeDecodeError, pa.ArrowInvalid) as e:
+        # 只有解碼失敗才改用 latin1 重讀；型別轉換錯誤（如 prc 非數值）直接拋出原訊息
+        if isinstance(e, pa.ArrowInvalid) and "invalid UTF8" not in str(e):
+            raise
         print("⚠️ UTF-8 解碼失敗，改用 latin1")
-        df = pd.read_csv(file_path, encoding="latin1", on_bad_lines="skip", low_memory=False)
+        _csv_to_parquet(file_path, cached, dtypes, keep, "latin1")
+    return cached
+
+
+def _save(df, path):
+    """以 Parquet（zstd）輸出，取代寫入 Drive 的 CSV"""
+    df.to_parquet(path, engine="pyarrow", compression="zstd", index=False)
+
 
-    # 標準化欄位
-    df.columns = [col.lower().strip() for col in df.columns]
+def _stage_local(src):
+    """Drive 檔案複製到本機 SSD（保留 mtime；Drive 上檔案更新時重新複製），回傳本機路徑"""
+    dst = os.path.join(LOCAL_DIR, os.path.basename(src))
+    if not os.path.exists(dst) or os.path.getmtime(dst) != os.path.getmtime(src):
+        print(f"📥 Staging {src} → {dst}")
+        shutil.copy2(src, dst)
+    return dst
 
-    rename_dict = {"public_date": "date", "datadate": "date"}
-    df.rename(columns={c: rename_dict[c] for c in df.columns if c in rename_dict}, inplace=True)
 
-    # gvkey / permno 自動標準化
-    for col in df.columns:
-        if "gvkey" in col:
-            df.rename(columns={col: "gvkey"}, inplace=True)
-        if "permno" in col:
-            df.rename(columns={col: "permno"}, inplace=True)
+def _stage_cache_path(raw_path, keep, name):
+    """Step 1–4 結果的快取路徑：以原始檔修改時間 + 保留欄位產生 key，任一變動即失效"""
+    key = hashlib.md5(f"{os.path.getmtime(raw_path)}:{sorted(keep)}".encode()).hexdigest()[:8]
+    return os.path.join(os.path.dirname(raw_path), f"cache_{name}_{key}.parquet")
+
+
+def load_csv(file_path, dtypes=None, keep=None, encoding="utf-8"):
+    """讀取 CSV（經 Parquet 快取）+ 標準化欄位名稱 + 只保留 keep 欄位 + 回傳 DataFrame"""
+    print(f"\n📂 Loading file: {file_path}")
+
+    dtypes = dtypes or {}
+    cached = _cached_parquet(file_path, dtypes, keep, encoding)
+
+    # 讀取時只投影 keep 欄位，其餘欄位完全不進記憶體
+    columns = None
+    if keep is not None:
+        columns = [c for c in pq.read_schema(cached).names if _normalize_column(c) in keep]
+    df = pd.read_parquet(cached, columns=columns)
+
+    # 標準化欄位（一次算出全部新欄名，欄位索引只重建一次）
+    df.columns = [_normalize_column(col) for col in df.columns]
 
     # 日期格式
     if "date" in df.columns:
         df["date"] = pd.to_datetime(df["date"], errors="coerce")
 
+    # Parquet 不保留 pandas 可空整數（如 IBES permno），依 schema 還原
+    df = df.astype({c: t for c, t in dtypes.items() if c in df.columns})
+
+    # 未在 dtype schema 內的 float64 欄位一律降為 float32
+    float_cols = df.select_dtypes("float64").columns
+    df[float_cols] = df[float_cols].astype(np.float32)
+
     print(f"✔ rows: {len(df)}, columns: {len(df.columns)}")
     return df
 
@@ -47,59 +175,117 @@ def load_csv(file_path, encoding="utf-8"):
 # 2. 分組排序
 # ============================================================
 
-def sort_by_group(df, date_col="date"):
-    """依照 gvkey 或 permno 分組並排序"""
-    key = "gvkey" if "gvkey" in df.columns else "permno"
-    return df.sort_values([key, date_col])
+def sort_by_group(df, keys=None, date_col="date"):
+    """建立整數組別代碼 _gid（預設依 gvkey 或 permno）並依 _gid、日期排序一次，後續 groupby 共用"""
+    if keys is None:
+        keys = ["gvkey" if "gvkey" in df.columns else "permno"]
+    df["_gid"] = (
+        df.groupby(keys, observed=True)
+        .ngroup()
+        .to_numpy(dtype=np.int32, na_value=-1)
+    )
+    return df.sort_values(["_gid", date_col], kind="stable")
 
 
 # ============================================================
-# 3. 移除重複資料（CRSP）
+# 3. 找出連續月份資料
 # ============================================================
 
-def remove_duplicate_permno_date(df, output_path):
-    """刪除 permno+date 重複資料，輸出被刪除資料"""
-    print("\n🧹 Removing duplicate (permno, date) rows...")
+def _month_gaps(df):
+    """月份索引、與上一筆的月份差、缺口旗標、是否與上一筆同組（df 需已依 _gid、date 排序）"""
+    gid = df["_gid"].to_numpy()
+    month = df["date"].values.astype("datetime64[M]")
 
-    before = len(df)
-    dup = df[df.duplicated(subset=["permno", "date"], keep=False)]
-    dup.to_csv(output_path, index=False)
+    # NaT（日期無法解析）轉成 int64 為最小值，差分會溢位；不參與月份差計算，仍歸屬原組別
+    valid = ~np.isnat(month)
+    month = np.where(valid, month.astype(np.int64), 0)
+    step = np.diff(month, prepend=month[:1])
 
-    df_clean = df.drop_duplicates(subset=["permno", "date"], keep="first")
+    same_group = np.zeros(len(df), dtype=bool)
+    same_group[1:] = gid[1:] == gid[:-1]
 
-    print(f"✔ Before: {before}, After: {len(df_clean)}, Removed: {len(dup)}")
-    return df_clean
+    both_valid = valid.copy()
+    both_valid[1:] &= valid[:-1]
+    step[~both_valid] = 0
 
+    gap = same_group & (step > 1)
+    return month, step, gap, same_group
+
+
+def _group_any(flag, same_group):
+    """組內任一列為 True → 整組為 True（逐組 logical_or.reduceat 後展開回列）"""
+    if len(flag) == 0:
+        return flag
+    starts = np.flatnonzero(~same_group)
+    sizes = np.diff(np.append(starts, len(flag)))
+    return np.repeat(np.logical_or.reduceat(flag, starts), sizes)
+
+
+def _missing_months(df, id_col, month, step, gap):
+    """每個缺口展開為 (上一筆, 本筆) 之間的月份，不逐組處理"""
+    n_missing = step[gap] - 1
+    first_missing = month[gap] - n_missing
+    offset = np.arange(n_missing.sum()) - np.repeat(np.cumsum(n_missing) - n_missing, n_missing)
+    return pd.DataFrame({
+        id_col: np.repeat(df.loc[gap, id_col].to_numpy(), n_missing),
+        "missing_date": (np.repeat(first_missing, n_missing) + offset)
+        .astype("datetime64[M]").astype("datetime64[ns]"),
+    })
 
-# ============================================================
-# 4. 找出連續月份資料
-# ============================================================
 
 def extract_continuous_monthly(df, id_col, delete_file, missing_file):
     """拆分連續 vs 不連續月份資料，並輸出不連續部分 + 缺失月份"""
     print(f"\n📅 Checking monthly continuity for {id_col}...")
 
     df["date"] = pd.to_datetime(df["date"])
-    continuous, removed, missing_records = [], [], []
 
-    for id_value, group in df.groupby(id_col):
-        group = group.sort_values("date")
-        months = pd.date_range(group["date"].min(), group["date"].max(), freq="MS")
-        missing = months.difference(group["date"].dt.to_period("M").dt.to_timestamp())
+    # 同組相鄰兩筆相差 > 1 個月即不連續
+    month, step, gap, same_group = _month_gaps(df)
+    mask = _group_any(gap, same_group)
+
+    continuous_df = df[~mask]
+    removed_df = df[mask]
+
+    _save(removed_df.drop(columns="_gid"), delete_file)
+    _save(_missing_months(df, id_col, month, step, gap), missing_file)
+
+    print(f"✔ Continuous groups: {len(continuous_df)}, Removed groups: {len(removed_df)}")
+    return continuous_df
+
+
+# ============================================================
+# 4. 移除重複資料 + 連續月份檢查（CRSP，單次掃描）
+# ============================================================
 
-        if len(missing) == 0:
-            continuous.append(group)
-        else:
-            removed.append(group)
-            for m in missing:
-                missing_records.append([id_value, m])
+def dedupe_and_extract_continuous(df, dup_file, delete_file, missing_file):
+    """刪除 permno+date 重複資料並拆分連續月份資料；排序一次、同一組陣列上算出全部旗標"""
+    print("\n🧹 Removing duplicate (permno, date) rows + checking monthly continuity...")
+
+    df["date"] = pd.to_datetime(df["date"])
+    before = len(df)
 
-    removed_df = pd.concat(removed) if removed else pd.DataFrame()
-    continuous_df = pd.concat(continuous) if continuous else pd.DataFrame()
+    # 已依 _gid、date 排序 → 重複的 (permno, date) 必相鄰
+    month, step, gap, same_group = _month_gaps(df)
+    day = df["date"].values.astype("datetime64[D]")
+    nat = np.isnat(day)
+    same_as_prev = same_group.copy()
+    same_as_prev[1:] &= (day[1:] == day[:-1]) | (nat[1:] & nat[:-1])   # 與 drop_duplicates 相同，NaT 視為相等
+    dup_mask = same_as_prev | np.append(same_as_prev[1:], False)
 
-    removed_df.to_csv(delete_file, index=False)
-    pd.DataFrame(missing_records, columns=[id_col, "missing_date"]).to_csv(missing_file, index=False)
+    # 重複列與上一筆同月（月份差 0），不影響缺口判斷
+    bad_mask = _group_any(gap, same_group)
 
+    _save(df[dup_mask].drop(columns="_gid"), dup_file)
+    kept = ~same_as_prev
+    df = df[kept]
+
+    continuous_df = df[~bad_mask[kept]]
+    removed_df = df[bad_mask[kept]]
+
+    _save(removed_df.drop(columns="_gid"), delete_file)
+    _save(_missing_months(df, "permno", month[kept], step[kept], gap[kept]), missing_file)
+
+    print(f"✔ Before: {before}, After dedupe: {len(df)}, Duplicates: {dup_mask.sum()}")
     print(f"✔ Continuous groups: {len(continuous_df)}, Removed groups: {len(removed_df)}")
     return continuous_df
 
@@ -109,12 +295,20 @@ def extract_continuous_monthly(df, id_col, delete_file, missing_file):
 # ============================================================
 
 def merge_crsp_ibes(crsp, ibes):
-    """以 permno + 月份合併"""
-    crsp["date"] = crsp["date"].dt.to_period("M")
-    ibes["date"] = ibes["date"].dt.to_period("M")
+    """以 permno + 月份合併（月份轉為 int64 key，不修改輸入資料）"""
+    crsp_month = crsp["date"].values.astype("datetime64[M]").astype(np.int64)
+    ibes_month = ibes["date"].values.astype("datetime64[M]").astype(np.int64)
+
+    merged = pd.merge(
+        crsp.drop(columns="_gid").assign(_mkey=crsp_month),
+        ibes.drop(columns=["_gid", "date"]).assign(_mkey=ibes_month),
+        on=["permno", "_mkey"], how="inner",
+    )
+    merged["date"] = merged.pop("_mkey").to_numpy().astype("datetime64[M]").astype("datetime64[ns]")
 
-    merged = pd.merge(crsp, ibes, on=["permno", "date"], how="inner")
-    merged["date"] = merged["date"].dt.to_timestamp()
+    # 合併後 CRSP / IBES 的 float32 欄位分屬不同 block，copy 一次整併為單一連續 block，
+    # 後續 preprocess / fill 逐欄掃描都走連續記憶體
+    merged = merged.copy()
 
     print(f"\n🔗 Merge done → rows={len(merged)}, permno={merged['permno'].nunique()}")
     return merged
@@ -127,10 +321,11 @@ def merge_crsp_ibes(crsp, ibes):
 def remove_data_before_year(data, date_column, cutoff_year):
     """刪除某年份以前的資料"""
     data[date_column] = pd.to_datetime(data[date_column], errors="coerce")
-    data["year"] = data[date_column].dt.year
 
+    # 直接與 datetime64 比較，不另建 year 欄位
     before = len(data)
-    data = data[data["year"] > cutoff_year].drop(columns=["year"])
+    cutoff = np.datetime64(f"{cutoff_year + 1}-01-01")
+    data = data.loc[data[date_column].values >= cutoff]
     after = len(data)
 
     print(f"\n⛔ Cut-off applied: removed {before - after} rows ≤ {cutoff_year}")
@@ -141,38 +336,39 @@ def remove_data_before_year(data, date_column, cutoff_year):
 # 7. 缺失值檢查與刪除不良股票
 # ============================================================
 
-def preprocess_data(df, columns_to_check):
+@njit(parallel=True, cache=True)
+def _bad_groups(na, gid, n_groups, limit):
+    """任一欄位組內連續 NA ≥ limit 的組別（各欄以 prange 平行；資料需依組別排序，gid = -1 不分組）"""
+    out = np.zeros(n_groups, np.bool_)
+    for c in prange(na.shape[1]):
+        run = 0
+        for i in range(na.shape[0]):
+            if i > 0 and gid[i] != gid[i - 1]:
+                run = 0
+            run = (run + 1) * na[i, c]
+            if run >= limit and gid[i] >= 0:
+                out[gid[i]] = True
+    return out
+
+
+def preprocess_data(df, columns_to_check, deleted_file):
     print(f"\n📌 Preprocess → 原始筆數: {df.shape[0]}")
 
-    deleted = []
-    drop_list = []
-
-    for (permno, ncusip), group in df.groupby(["permno", "ncusip"]):
-
-        for col in columns_to_check:
-            if col not in df.columns:
-                continue
-
-            # 連續 ≥ 8 個 NA → 刪除該股票
-            consec_na = (
-                group[col].isna()
-                .astype(int)
-                .groupby(group[col].notna().astype(int).cumsum())
-                .sum()
-                .max()
-            )
+    # df 已依 (permno, ncusip) 的 _gid 與日期排序
+    gid = df["_gid"].to_numpy()
+    n_groups = gid.max() + 1 if len(gid) else 0
 
-            if consec_na >= 8:
-                drop_list.append((permno, ncusip))
-                deleted.append(group)
-                break
+    # 任一欄位連續 ≥ 8 個 NA → 刪除該股票；NA 矩陣採 column-major，逐欄掃描走連續記憶體
+    cols = [c for c in columns_to_check if c in df.columns]
+    na = np.asfortranarray(df[cols].isna().to_numpy(dtype=np.int8))
+    bad = _bad_groups(na, gid, n_groups, 8)
 
-    mask = df.set_index(["permno", "ncusip"]).index.isin(drop_list)
+    mask = np.append(bad, False)[gid]
     df_clean = df[~mask]
 
-    print(f"✔ Removed {len(drop_list)} bad permno/ncusip groups")
+    print(f"✔ Removed {bad.sum()} bad permno/ncusip groups")
 
-    pd.concat(deleted).to_csv("/drive/MyDrive/論文/data/deleted_groups.csv", index=False)
+    _save(df[mask].drop(columns="_gid"), deleted_file)
 
     return df_clean
 
@@ -184,11 +380,16 @@ def preprocess_data(df, columns_to_check):
 def fill_missing_values(df, cols):
     print("\n🧩 Filling missing values...")
 
-    for col in cols:
-        if col in df.columns:
-            df[col] = df.groupby(["permno", "ncusip"])[col].apply(
-                lambda x: x.ffill().bfill()
-            )
+    # 整塊欄位一次以 Cython 的 groupby ffill / bfill 處理（df 已依 _gid、date 排序）
+    # 只填有組別的列；_gid = -1（ncusip 缺失）的列保持原值（groupby 會對其回傳 NaN，不可整欄回寫）
+    cols = [c for c in cols if c in df.columns]
+    keyed = (df["_gid"] >= 0).to_numpy()
+
+    # 只取填補需要的欄位，不複製整個合併表
+    part = df.loc[keyed, cols + ["_gid"]]
+    filled = part.groupby("_gid", sort=False)[cols].ffill()
+    filled = filled.groupby(part["_gid"], sort=False).bfill()
+    df.loc[keyed, cols] = filled
 
     print("✔ Missing values filled.")
     return df
@@ -201,48 +402,55 @@ def fill_missing_values(df, cols):
 IBES_raw = "/drive/MyDrive/論文/data/financial_ratio_all_IBES.csv"
 CRSP_raw = "/drive/MyDrive/論文/data/CRSP_Stock_price_Monthly_final.csv"
 
-dup_CRSP = "/drive/MyDrive/論文/data/price_duplicate.csv"
-noncon_IBES = "/drive/MyDrive/論文/data/non_continuous_data1.csv"
-noncon_IBES_dates = "/drive/MyDrive/論文/data/non_continuous_date1.csv"
-noncon_CRSP = "/drive/MyDrive/論文/data/non_continuous_data2.csv"
-noncon_CRSP_dates = "/drive/MyDrive/論文/data/non_continuous_date2.csv"
+dup_CRSP = "/content/data/price_duplicate.parquet"
+noncon_IBES = "/content/data/non_continuous_data1.parquet"
+noncon_IBES_dates = "/content/data/non_continuous_date1.parquet"
+noncon_CRSP = "/content/data/non_continuous_data2.parquet"
+noncon_CRSP_dates = "/content/data/non_continuous_date2.parquet"
+deleted_groups = "/content/data/deleted_groups.parquet"
+
+merged_final_path = "/drive/MyDrive/論文/data/merged_data_final.parquet"
 
-merged_final_path = "/drive/MyDrive/論文/data/merged_data_final.csv"
+crsp_cache = _stage_cache_path(CRSP_raw, CRSP_KEEP, "crsp")
+ibes_cache = _stage_cache_path(IBES_raw, IBES_KEEP, "ibes")
 
-# Step 1: Load
-crsp = load_csv(CRSP_raw)
-ibes = load_csv(IBES_raw)
+if os.path.exists(crsp_cache) and os.path.exists(ibes_cache):
+    # 原始檔未變動：直接讀取 Step 1–4 的快取（存於 Drive，跨 Colab session 有效，不需複製原始檔）
+    print(f"\n⚡ 使用快取（略過 Step 1–4）: {crsp_cache}, {ibes_cache}")
+    crsp_clean = pd.read_parquet(crsp_cache)
+    ibes_clean = pd.read_parquet(ibes_cache)
+else:
+    # Step 1: Load（先複製到本機 SSD）
+    crsp = load_csv(_stage_local(CRSP_raw), CRSP_DTYPES, CRSP_KEEP)
+    ibes = load_csv(_stage_local(IBES_raw), IBES_DTYPES, IBES_KEEP)
 
-# Step 2: Sort
-crsp = sort_by_group(crsp)
-ibes = sort_by_group(ibes)
+    # Step 2: Sort
+    crsp = sort_by_group(crsp)
+    ibes = sort_by_group(ibes)
 
-# Step 3: Remove duplicate rows (CRSP only)
-crsp = remove_duplicate_permno_date(crsp, dup_CRSP)
+    # Step 3 + 4: Remove duplicate rows (CRSP only) + keep only continuous monthly data
+    ibes_clean = extract_continuous_monthly(ibes, "gvkey", noncon_IBES, noncon_IBES_dates)
+    crsp_clean = dedupe_and_extract_continuous(crsp, dup_CRSP, noncon_CRSP, noncon_CRSP_dates)
 
-# Step 4: Keep only continuous monthly data
-ibes_clean = extract_continuous_monthly(ibes, "gvkey", noncon_IBES, noncon_IBES_dates)
-crsp_clean = extract_continuous_monthly(crsp, "permno", noncon_CRSP, noncon_CRSP_dates)
+    _save(crsp_clean, crsp_cache)
+    _save(ibes_clean, ibes_cache)
 
 # Step 5: Merge CRSP × IBES
 merged = merge_crsp_ibes(crsp_clean, ibes_clean)
 
 # ⭐ Step 6: Remove data ≤ 1970
 merged = remove_data_before_year(merged, "date", 1970)
+merged = sort_by_group(merged, ["permno", "ncusip"])
 
 # Step 7: Preprocess — remove bad stocks
-cols_to_check = [
-    "bm","evm","pe_exi","pe_inc","ptb","gprof","gpm","npm",
-    "opmad","roa","roe","cfm","cash_debt","short_debt",
-    "curr_debt","de_ratio","debt_at","quick_ratio",
-    "curr_ratio","rect_turn","at_turn","rd_sale","prc"
-]
-merged = preprocess_data(merged, cols_to_check)
+cols_to_check = RATIO_COLS + ["prc"]
+merged = preprocess_data(merged, cols_to_check, deleted_groups)
 
 # Step 8: Fill missing values
 merged = fill_missing_values(merged, cols_to_check)
 
 # Step 9: Save result
-merged.to_csv(merged_final_path, index=False)
+merged = merged.drop(columns="_gid")
+_save(merged, merged_final_path)
 print("\n🎉 完成！Final dataset saved:", merged_final_path)
 
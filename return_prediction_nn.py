@@ -11,7 +11,8 @@ import time
 import psutil
 from google.colab import drive
 
-drive.mount('/drive', force_remount=True)
+if not os.path.ismount('/drive'):
+    drive.mount('/drive')
 
 # 設定隨機種子，確保結果可重現
 def set_random_seed(seed):
@@ -24,8 +25,11 @@ def set_random_seed(seed):
 def train_and_predict(data, start_date, end_date, prediction_date, growth_period, seed=10):
     set_random_seed(seed)
 
-    # 擷取訓練視窗資料
-    window_data = data.loc[start_date:end_date]
+    # 擷取訓練視窗資料：日期已排序，以二分搜尋取列範圍（等同 data.loc[start_date:end_date]）
+    dates = data.index.values
+    i0 = np.searchsorted(dates, np.datetime64(start_date), side='left')
+    i1 = np.searchsorted(dates, np.datetime64(end_date), side='right')
+    window_data = data.iloc[i0:i1]
     if window_data.empty:
         print(f"📭 無可用資料區間：{start_date} ~ {end_date}")
         return None, None, None, None, None
@@ -68,8 +72,10 @@ def train_and_predict(data, start_date, end_date, prediction_date, growth_period
 
     training_time = end_time - start_time
 
-    # 準備預測資料
-    prediction_data = data[data.index == prediction_date]
+    # 準備預測資料（同樣以二分搜尋取預測日的列範圍）
+    p0 = np.searchsorted(dates, np.datetime64(prediction_date), side='left')
+    p1 = np.searchsorted(dates, np.datetime64(prediction_date), side='right')
+    prediction_data = data.iloc[p0:p1]
     if prediction_data.empty:
         print(f"📭 無預測日期資料：{prediction_date}")
         return None, None, None, None
@@ -81,8 +87,8 @@ def train_and_predict(data, start_date, end_date, prediction_date, growth_period
 
     X_pred = sc.transform(X_pred)
 
-    # 進行預測
-    y_pred = model.predict(X_pred).flatten()
+    # 進行預測（單一截面一次送入；predict_on_batch 省去 predict 每次建立資料管線的固定成本）
+    y_pred = np.asarray(model.predict_on_batch(X_pred)).flatten()
 
     return y_pred, prediction_data[f'PRC GROWTH {growth_period}m'], \
            prediction_data[['permno', 'ncusip']], X_pred, training_time
@@ -94,10 +100,10 @@ def process_all_windows_and_years(base_path):
     prediction_years = [2, 3, 4, 5]  # 預測 horizon：2、3、4、5 年
 
     for growth_period in growth_periods:
-        dataset_path = f'/drive/MyDrive/論文/data/final_result_{growth_period}m.csv'
+        dataset_path = f'/drive/MyDrive/論文/data/final_result_{growth_period}m.parquet'
 
         if os.path.exists(dataset_path):
-            dataset = pd.read_csv(dataset_path)
+            dataset = pd.read_parquet(dataset_path)
             dataset['date'] = pd.to_datetime(dataset['date'])
             dataset = dataset.sort_values('date')
             dataset.set_index('date', inplace=True)
@@ -2,58 +2,98 @@ import os
 import random
 import numpy as np
 import pandas as pd
-from sklearn.model_selection import train_test_split
+
+# 有安裝 Intel sklearnex 時改用 oneDAL 實作（須在匯入 sklearn 之前 patch）
+try:
+    from sklearnex import patch_sklearn
+    patch_sklearn()
+except ImportError:
+    print("ℹ️ 未安裝 sklearnex，使用原生 scikit-learn")
+
 from sklearn.ensemble import RandomForestRegressor
-from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import mean_squared_error, mean_absolute_error
 from dateutil.relativedelta import relativedelta
 import time
 import psutil
+from joblib import Parallel, delayed
 from google.colab import drive
 
-drive.mount('/drive', force_remount=True)
+# 有 GPU 且安裝 RAPIDS cuML 時改在 GPU 上訓練隨機森林
+try:
+    from cuml.ensemble import RandomForestRegressor as cuRandomForestRegressor
+    USE_GPU = True
+except ImportError:
+    USE_GPU = False
+
+if not os.path.ismount('/drive'):
+    drive.mount('/drive')
+
+# 特徵欄位
+FEATURE_COLS = ['bm', 'pe_exi', 'pe_inc', 'ptb', 'gprof', 'gpm',
+                'npm', 'opmad', 'roa', 'roe', 'cfm', 'cash_debt',
+                'short_debt', 'curr_debt', 'de_ratio', 'debt_at',
+                'quick_ratio', 'curr_ratio', 'rect_turn', 'at_turn', 'rd_sale']
+
+# 隨機森林設定（維持研究使用的 5 棵樹）
+RF_PARAMS = {'n_estimators': 5}
+
+# 外層依預測日期平行的行程數（GPU 只有一張時依序執行）；外層依序時改由樹本身多執行緒
+OUTER_N_JOBS = 1 if USE_GPU else -1
+RF_N_JOBS = -1 if OUTER_N_JOBS == 1 else 1
 
-# 設定隨機種子，確保模型結果可重現
+# 設定隨機種子，確保模型結果可重現（模組載入時設定一次；各視窗的模型另以 random_state 固定）
 def set_random_seed(seed):
-    os.environ['PYTHONHASHSEED'] = str(seed)
     random.seed(seed)
     np.random.seed(seed)
 
-# 訓練 + 預測函式
-def train_and_predict(data, start_date, end_date, prediction_date, growth_period, seed=42):
-    set_random_seed(seed)
 
-    # 擷取訓練視窗資料
-    window_data = data.loc[start_date:end_date]
-    if window_data.empty:
-        print(f"⚠️ 區間無資料：{start_date} ~ {end_date}")
-        return None, None, None, None, None
+set_random_seed(42)
 
-    # 取 permno 與 ncusip 做標識
-    stock_ids = window_data[['permno', 'ncusip']].copy()
+# 載入資料集：只讀需要的欄位（舊版 CSV 輸出先轉存一次 Parquet）；特徵一律 float32，並依日期排序一次
+def load_dataset(dataset_path, growth_period):
+    if not os.path.exists(dataset_path):
+        csv_path = dataset_path.replace('.parquet', '.csv')
+        dataset = pd.read_csv(csv_path, engine='pyarrow', dtype={col: 'float32' for col in FEATURE_COLS})
+        dataset.to_parquet(dataset_path, engine='pyarrow', compression='zstd', index=False)
 
-    # 特徵與目標值
-    X = window_data[['bm', 'pe_exi', 'pe_inc', 'ptb', 'gprof', 'gpm',
-                     'npm', 'opmad', 'roa', 'roe', 'cfm', 'cash_debt',
-                     'short_debt', 'curr_debt', 'de_ratio', 'debt_at',
-                     'quick_ratio', 'curr_ratio', 'rect_turn', 'at_turn', 'rd_sale']]
+    columns = ['date', 'permno', 'ncusip', *FEATURE_COLS, f'PRC GROWTH {growth_period}m']
+    dataset = pd.read_parquet(dataset_path, engine='pyarrow', columns=columns)
+    dataset['date'] = pd.to_datetime(dataset['date'])
+    dataset[FEATURE_COLS] = dataset[FEATURE_COLS].astype(np.float32)
+    dataset = dataset.sort_values('date', kind='stable')
+    dataset.set_index('date', inplace=True)
+    return dataset
 
-    y = window_data[f'PRC GROWTH {growth_period}m']
 
-    # 拆分訓練 / 驗證資料
-    X_train, X_val, y_train, y_val = train_test_split(
-        X, y, test_size=0.1, random_state=seed
-    )
+# 訓練 + 預測函式（dates / X_all / y_all 為整份資料預先轉好的 numpy 陣列，平行執行時由 joblib 以 memmap 共用）
+def train_and_predict(dates, X_all, y_all, start_date, end_date, prediction_date, seed=42):
+    # 以二分搜尋在已排序的日期上切出訓練視窗（等同 data.loc[start_date:end_date]）
+    i0 = np.searchsorted(dates, np.datetime64(start_date), side='left')
+    i1 = np.searchsorted(dates, np.datetime64(end_date), side='right')
+    if i0 == i1:
+        print(f"⚠️ 區間無資料：{start_date} ~ {end_date}")
+        return None, None, None, None
+
+    # 特徵與目標值
+    X = X_all[i0:i1]
+    y = y_all[i0:i1]
 
-    # 標準化特徵
-    sc = StandardScaler()
-    X_train = sc.fit_transform(X_train)
-    X_val = sc.transform(X_val)
+    # 拆分訓練 / 驗證資料：視窗已依日期排序，最後 10% 的期間作驗證，避免以未來資料訓練（切片即可，不需洗牌）
+    k = len(X) - int(np.ceil(0.1 * len(X)))
+    X_train, X_val, y_train, y_val = X[:k], X[k:], y[:k], y[k:]
 
-    # 建立隨機森林模型
-    model = RandomForestRegressor(n_estimators=5, random_state=seed)
+    # 樹模型只依各特徵的大小順序切分，不需標準化
 
-    # 訓練模型
+    # 建立隨機森林模型（CPU：依 RF_N_JOBS 避免與外層平行重複開執行緒；GPU：單一 stream 確保可重現）
+    if USE_GPU:
+        model = cuRandomForestRegressor(**RF_PARAMS, random_state=seed, n_streams=1)
+        y_train = y_train.astype(np.float32)
+    else:
+        model = RandomForestRegressor(**RF_PARAMS, random_state=seed, n_jobs=RF_N_JOBS)
+
+    # 訓練模型（特徵須為 C-contiguous float32；sklearn 目標值為 float64、cuML 為 float32，才不會再轉型複製）
+    assert X_train.flags.c_contiguous and X_train.dtype == np.float32
+    assert y_train.dtype == (np.float32 if USE_GPU else np.float64)
     start_time = time.time()
     model.fit(X_train, y_train)
     end_time = time.time()
@@ -65,23 +105,20 @@ def train_and_predict(data, start_date, end_date, prediction_date, growth_period
     val_mae = mean_absolute_error(y_val, val_predictions)
     print(f"📊 驗證 RMSE: {val_rmse}, MAE: {val_mae}")
 
-    # 準備預測資料
-    prediction_data = data[data.index == prediction_date]
-    if prediction_data.empty:
+    # 準備預測資料：同樣以二分搜尋找出預測日的列範圍（回傳列位置，由主流程取 permno 與 ncusip 做標識）
+    p0 = np.searchsorted(dates, np.datetime64(prediction_date), side='left')
+    p1 = np.searchsorted(dates, np.datetime64(prediction_date), side='right')
+    if p0 == p1:
         print(f"⚠️ 無預測資料：{prediction_date}")
-        return None, None, None, None, None
-
-    X_pred = prediction_data[['bm', 'pe_exi', 'pe_inc', 'ptb', 'gprof', 'gpm',
-                              'npm', 'opmad', 'roa', 'roe', 'cfm', 'cash_debt',
-                              'short_debt', 'curr_debt', 'de_ratio', 'debt_at',
-                              'quick_ratio', 'curr_ratio', 'rect_turn', 'at_turn', 'rd_sale']]
+        return None, None, None, None
 
-    X_pred = sc.transform(X_pred)
+    pred_idx = np.arange(p0, p1)
+    X_pred = X_all[p0:p1]
 
     # 預測未來成長率
     y_pred = model.predict(X_pred)
 
-    return y_pred, prediction_data[f'PRC GROWTH {growth_period}m'], stock_ids, X_pred, training_time
+    return y_pred, y_all[p0:p1], pred_idx, training_time
 
 
 # 主流程：處理不同視窗與不同預測年期
@@ -90,15 +127,18 @@ def process_all_windows_and_years(base_path):
     prediction_years = [4, 5]  # 預測 horizon 為 4 年與 5 年
 
     for growth_period in growth_periods:
-        dataset_path = f'/drive/MyDrive/論文/data/final_result_{growth_period}m.csv'
+        dataset_path = f'/drive/MyDrive/論文/data/final_result_{growth_period}m.parquet'
 
-        if os.path.exists(dataset_path):
+        if os.path.exists(dataset_path) or os.path.exists(dataset_path.replace('.parquet', '.csv')):
 
-            # 載入資料
-            dataset = pd.read_csv(dataset_path)
-            dataset['date'] = pd.to_datetime(dataset['date'])
-            dataset = dataset.sort_values('date')
-            dataset.set_index('date', inplace=True)
+            # 載入資料（只載入一次，所有預測年期共用）
+            dataset = load_dataset(dataset_path, growth_period)
+            # sklearn 樹模型以 C-contiguous float32 特徵為原生格式，先轉好避免每次 fit 內部複製
+            X_all = np.ascontiguousarray(dataset[FEATURE_COLS].to_numpy(dtype=np.float32))
+            y_all = dataset[f'PRC GROWTH {growth_period}m'].to_numpy(dtype=np.float64)
+            dates = dataset.index.values
+            permno_all = dataset['permno'].to_numpy()
+            ncusip_all = dataset['ncusip'].to_numpy()
 
             for years in prediction_years:
 
@@ -106,47 +146,51 @@ def process_all_windows_and_years(base_path):
                 earliest_date = dataset.index.min()
                 print(f"📅 資料最早日期：{earliest_date}")
 
-                # 設定第一個預測日期
+                # 列出所有預測日期（第一個預測日期起逐月往後推）
+                prediction_dates = []
                 prediction_date = earliest_date + relativedelta(years=years)
+                while prediction_date <= dataset.index.max():
+                    prediction_dates.append(prediction_date)
+                    prediction_date += relativedelta(months=1)
 
                 all_results = []
                 total_training_time = 0
                 start_memory = psutil.virtual_memory().used
 
-                # 滾動視窗逐月預測
-                while prediction_date <= dataset.index.max():
-
-                    start_date = prediction_date - relativedelta(years=years) + relativedelta(days=1)
-                    end_date = prediction_date - relativedelta(days=1)
-
-                    y_pred, y_true, stock_ids, X_pred, training_time = \
-                        train_and_predict(dataset, start_date, end_date, prediction_date, growth_period)
+                # 滾動視窗：各預測日期的模型互相獨立，平行訓練（結果依日期順序回傳）
+                windows = [(d - relativedelta(years=years) + relativedelta(days=1), d - relativedelta(days=1), d)
+                           for d in prediction_dates]
+                outputs = Parallel(n_jobs=OUTER_N_JOBS, backend='loky')(
+                    delayed(train_and_predict)(dates, X_all, y_all, start_date, end_date, prediction_date)
+                    for start_date, end_date, prediction_date in windows
+                )
 
-                    total_training_time += training_time
+                for (start_date, end_date, prediction_date), (y_pred, y_true, pred_idx, training_time) \
+                        in zip(windows, outputs):
 
                     if y_pred is not None and y_true is not None:
+                        total_training_time += training_time
 
-                        results_df = pd.DataFrame({
-                            'permno': stock_ids['permno'].values,
-                            'ncusip': stock_ids['ncusip'].values,
-                            'Date': [prediction_date] * len(y_pred),
-                            'True Values': y_true.values,
-                            'Predicted Values': y_pred,
-                            'Window Start': [start_date] * len(y_pred),
-                            'Window End': [end_date] * len(y_pred)
-                        })
-
-                        all_results.append(results_df)
+                        # 只累積列位置與預測值，最後一次組成 DataFrame
+                        all_results.append((pred_idx, y_true, y_pred, prediction_date, start_date, end_date))
                         print(f"✅ 完成預測：{prediction_date}")
 
-                    # 預測日期往後推一個月
-                    prediction_date += relativedelta(months=1)
-
                 # 計算記憶體使用量
                 end_memory = psutil.virtual_memory().used
 
                 # 合併所有預測結果
-                final_results_df = pd.concat(all_results)
+                pred_idx, y_true, y_pred, pred_dates, start_dates, end_dates = zip(*all_results)
+                counts = [len(idx) for idx in pred_idx]
+                pred_idx = np.concatenate(pred_idx)
+                final_results_df = pd.DataFrame({
+                    'permno': permno_all[pred_idx],
+                    'ncusip': ncusip_all[pred_idx],
+                    'Date': np.repeat(pd.DatetimeIndex(pred_dates), counts),
+                    'True Values': np.concatenate(y_true),
+                    'Predicted Values': np.concatenate(y_pred),
+                    'Window Start': np.repeat(pd.DatetimeIndex(start_dates), counts),
+                    'Window End': np.repeat(pd.DatetimeIndex(end_dates), counts)
+                })
 
                 # 計算整體 RMSE 與 MAE
                 overall_rmse = np.sqrt(mean_squared_error(
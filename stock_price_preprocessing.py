@@ -1,17 +1,46 @@
+import os
+import numpy as np
 import pandas as pd
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
 from google.colab import drive
 
+if not os.path.ismount('/drive'):
+    drive.mount('/drive')
+
+CSV_BLOCK_SIZE = 64 << 20   # pyarrow 讀 CSV 時每個執行緒處理的區塊大小
+
 
 # ===============================================
 # 基本讀取＋欄位清理
 # ===============================================
 
-def load_csv_and_record_rows(file_path):
-    """讀取 CSV、標準化欄位名稱、印出基本資訊"""
-    drive.mount('/drive', force_remount=True)
+def _cached_parquet(file_path):
+    """回傳 CSV 對應的 Parquet 快取路徑，不存在或 CSV 已更新（mtime 不同）時以 pyarrow 多執行緒讀取並轉檔（zstd）"""
+    cached = file_path + '.parquet'
+    if os.path.exists(cached) and os.stat(cached).st_mtime_ns == os.stat(file_path).st_mtime_ns:
+        return cached
+
+    print(f"🗜️ 建立 Parquet 快取: {cached}")
+    mtime_ns = os.stat(file_path).st_mtime_ns
+    table = pv.read_csv(
+        file_path,
+        read_options=pv.ReadOptions(use_threads=True, block_size=CSV_BLOCK_SIZE),
+    )
+    tmp = cached + '.tmp'
+    pq.write_table(table, tmp, compression='zstd')
+    # 快取檔的 mtime 設為讀取前來源 CSV 的 mtime，之後以此判斷 CSV 是否更新過
+    os.utime(tmp, ns=(mtime_ns, mtime_ns))
+    os.replace(tmp, cached)
+    return cached
 
+
+def load_csv_and_record_rows(file_path):
+    """讀取 Parquet（CSV 則經 Parquet 快取）、標準化欄位名稱、印出基本資訊"""
     print(f"\n📂 正在處理檔案: {file_path}")
-    df = pd.read_csv(file_path, low_memory=False)
+    if not file_path.endswith('.parquet'):
+        file_path = _cached_parquet(file_path)
+    df = pd.read_parquet(file_path)
 
     # 標準化欄名
     df.columns = [col.lower().strip() for col in df.columns]
@@ -44,14 +73,35 @@ def load_csv_and_record_rows(file_path):
     return df
 
 
+# ===============================================
+# 工具函數：permno/ncusip 整數組別
+# ===============================================
+
+def assign_group_id(df):
+    """建立整數組別代碼 _gid（依 permno、ncusip；key 缺值為 -1），已存在則沿用，成長率與標準差計算共用"""
+    if '_gid' not in df.columns:
+        df['_gid'] = (
+            df.groupby(['permno', 'ncusip'], observed=True)
+            .ngroup()
+            .to_numpy(dtype=np.int32, na_value=-1)
+        )
+    return df
+
+
+def _group_key(df):
+    """groupby 用的組別鍵：_gid = -1（key 缺值）設為 NaN，不分組"""
+    return df['_gid'].where(df['_gid'] >= 0)
+
+
 # ===============================================
 # 工具函數：統計每月筆數
 # ===============================================
 
 def calculate_monthly_data_counts(df):
-    df['date'] = pd.to_datetime(df['date'])
-    result = df.assign(year_month=df['date'].dt.to_period('M'))['year_month'].value_counts().sort_index()
-    return result.reset_index().rename(columns={'index': 'year_month', 'year_month': 'count'})
+    # 以 datetime64[M] 整數月份計數，不逐列建立 Period 物件
+    ym = pd.to_datetime(df['date']).to_numpy().astype('datetime64[M]')
+    months, counts = np.unique(ym[~np.isnat(ym)], return_counts=True)
+    return pd.DataFrame({'year_month': pd.DatetimeIndex(months).to_period('M'), 'count': counts})
 
 
 # ===============================================
@@ -73,18 +123,25 @@ def calculate_prc_growth_and_shift(df):
 
     periods = [1, 3, 6, 9, 12]
 
-    # 計算 pct_change
-    for p in periods:
-        df[f'PRC GROWTH {p}m'] = df.groupby(['permno', 'ncusip'])['prc'].pct_change(p)
-
-    # shift upward
-    def shift_up(group):
-        for p in periods:
-            col = f'PRC GROWTH {p}m'
-            group[col] = group[col].shift(-p)
-        return group
+    # 已依 permno/ncusip/date 排序：同組資料連續，組別以 _gid 編號（缺值的 key 為 -1）
+    assign_group_id(df)
+    gid = df['_gid'].to_numpy()
+    prc = df['prc'].to_numpy()
 
-    df = df.groupby(['permno', 'ncusip'], group_keys=False).apply(shift_up)
+    # 計算 pct_change：整欄一次相除，再把往前 p 列已跨組（或 key 缺值）的結果設為 NaN
+    for p in periods:
+        growth = np.full(len(prc), np.nan, dtype=np.result_type(prc.dtype, np.float32))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            growth[p:] = prc[p:] / prc[:-p] - 1
+        growth[p:][gid[p:] != gid[:-p]] = np.nan
+        growth[gid < 0] = np.nan
+        df[f'PRC GROWTH {p}m'] = growth
+
+    # shift upward（向量化，不逐組呼叫 Python 函式）
+    grouped = df.groupby(_group_key(df), sort=False)
+    for p in periods:
+        col = f'PRC GROWTH {p}m'
+        df[col] = grouped[col].shift(-p)
 
     # 移除全為 NaN
     df.dropna(subset=[f'PRC GROWTH {p}m' for p in periods], how='all', inplace=True)
@@ -97,14 +154,10 @@ def calculate_prc_growth_and_shift(df):
 # ===============================================
 
 def export_growth_files(df):
-    periods = [1, 3, 6, 9, 12]
-
-    for p in periods:
-        col = f'PRC GROWTH {p}m'
-        output = df.drop(columns=[c for c in df.columns if c.startswith("PRC GROWTH") and c != col])
-        out_path = f'/drive/MyDrive/論文/data/final_result_{p}m.csv'
-        output.to_csv(out_path, index=False)
-        print(f"✔ 成長率 {p}m 已輸出 → {out_path}")
+    # 五個期間共用同一份特徵，只寫一個含全部成長率欄位的 Parquet，下游依欄位挑選
+    out_path = '/drive/MyDrive/論文/data/final_result.parquet'
+    df.drop(columns='_gid', errors='ignore').to_parquet(out_path, engine='pyarrow', compression='zstd', index=False)
+    print(f"✔ 成長率 1/3/6/9/12m 已輸出 → {out_path}")
 
 
 # ===============================================
@@ -112,32 +165,37 @@ def export_growth_files(df):
 # ===============================================
 
 def process_and_check_continuity(period):
-    path = f'/drive/MyDrive/論文/data/final_result_{period}m.csv'
-    df = pd.read_csv(path)
-    df['date'] = pd.to_datetime(df['date'])
+    src = '/drive/MyDrive/論文/data/final_result.parquet'
+    path = f'/drive/MyDrive/論文/data/final_result_{period}m.parquet'
 
+    # 只讀本期間的成長率欄位
     col = f'PRC GROWTH {period}m'
-    df = df.dropna(subset=[col])
-
-    continuous, non_continuous = [], []
-
-    for (_, _), g in df.groupby(['permno', 'ncusip']):
-        g = g.sort_values('date')
-        ym = g['date'].dt.to_period('M')
-        diff = ym.diff().dropna()
-
-        if (diff == 1).all():
-            continuous.append(g)
-        else:
-            non_continuous.append(g)
-
-    df_cont = pd.concat(continuous)
-    df_non = pd.concat(non_continuous)
-
-    df_cont.to_csv(path, index=False)
-    df_non.to_csv(f'/drive/MyDrive/論文/data/processed_result_{period}m_non_continuous.csv', index=False)
+    names = pq.read_schema(src).names
+    df = pd.read_parquet(src, columns=[c for c in names if not c.startswith('PRC GROWTH') or c == col])
+    df['date'] = pd.to_datetime(df['date'])
 
-    print(f"✔ {period}m：不連續 {len(non_continuous)} 組已輸出")
+    df = df.dropna(subset=[col])
+    df = df.sort_values(['permno', 'ncusip', 'date'], kind='stable')
+
+    # 全表一次算月份索引與組別（沿用 assign_group_id，取出後即移除 _gid），組界處不比較月份差
+    month = df['date'].to_numpy().astype('datetime64[M]').astype(np.int64)
+    gid = assign_group_id(df).pop('_gid').to_numpy()
+    boundary = np.ones(len(df), dtype=bool)
+    boundary[1:] = gid[1:] != gid[:-1]
+    is_ok = boundary | (np.diff(month, prepend=month[:1]) == 1)
+
+    # 組內每一列都與上一筆相差 1 個月 → 整組連續；permno/ncusip 缺值的列不屬於任何組
+    cont_mask = pd.Series(is_ok).groupby(gid).transform('all').to_numpy()
+    has_key = gid >= 0
+    df_cont = df[cont_mask & has_key]
+    df_non = df[~cont_mask & has_key]
+    n_non = len(np.unique(gid[~cont_mask & has_key]))
+
+    df_cont.to_parquet(path, engine='pyarrow', compression='zstd', index=False)
+    df_non.to_parquet(f'/drive/MyDrive/論文/data/processed_result_{period}m_non_continuous.parquet',
+                      engine='pyarrow', compression='zstd', index=False)
+
+    print(f"✔ {period}m：不連續 {n_non} 組已輸出")
     return df_cont, df_non
 
 
@@ -158,25 +216,25 @@ def calculate_std_dev_and_shift(df):
 
     periods = [1, 3, 6, 9, 12]
 
-    # rolling std
+    # rolling std（groupby().rolling 走 Cython 路徑，不逐組呼叫 lambda；依原 index 對齊回填）
+    assign_group_id(df)
+    grouped = df.groupby(_group_key(df), sort=False)
     for p in periods:
         col = f'PRC STD {p}m'
-        df[col] = df.groupby(['permno', 'ncusip'])['prc'].transform(lambda x: x.rolling(p, min_periods=1).std())
+        df[col] = grouped['prc'].rolling(p, min_periods=1).std().droplevel(0)
 
     # shift upward
+    grouped = df.groupby(_group_key(df), sort=False)
     for p in periods:
         col = f'PRC STD {p}m'
-        df[col] = df.groupby(['permno', 'ncusip'])[col].shift(-p)
+        df[col] = grouped[col].shift(-p)
 
     df.dropna(subset=[f'PRC STD {p}m' for p in periods], inplace=True)
 
-    # 輸出
-    for p in periods:
-        col = f'PRC STD {p}m'
-        out = df.drop(columns=[c for c in df.columns if c.startswith("PRC STD") and c != col])
-        path = f'/drive/MyDrive/論文/data/final_result_{p}m_std.csv'
-        out.to_csv(path, index=False)
-        print(f"✔ 標準差 {p}m 已輸出 → {path}")
+    # 輸出（單一 Parquet，含全部期間的標準差欄位）
+    path = '/drive/MyDrive/論文/data/final_result_std.parquet'
+    df.drop(columns='_gid').to_parquet(path, engine='pyarrow', compression='zstd', index=False)
+    print(f"✔ 標準差 1/3/6/9/12m 已輸出 → {path}")
 
     return df
 
@@ -186,8 +244,8 @@ def calculate_std_dev_and_shift(df):
 # ===============================================
 
 def remove_last_n_months(period):
-    path = f'/drive/MyDrive/論文/data/final_result_{period}m.csv'
-    df = pd.read_csv(path)
+    path = f'/drive/MyDrive/論文/data/final_result_{period}m.parquet'
+    df = pd.read_parquet(path)
     df['date'] = pd.to_datetime(df['date'])
 
     unique_dates = df['date'].sort_values().unique()
@@ -195,7 +253,7 @@ def remove_last_n_months(period):
         cutoff = unique_dates[-period]
         df = df[df['date'] < cutoff]
 
-    df.to_csv(path, index=False)
+    df.to_parquet(path, engine='pyarrow', compression='zstd', index=False)
     print(f"✔ 已刪除最後 {period} 個月 → {path}")
     return df
 
@@ -205,7 +263,11 @@ def remove_last_n_months(period):
 # ===============================================
 
 print("\n===== STEP 1: Load Data =====")
-df = load_csv_and_record_rows('/drive/MyDrive/論文/data/data_final.csv')
+# 直接讀 data_preprocessing 的輸出；沒有時才退回舊流程交接的 data_final.csv
+input_path = '/drive/MyDrive/論文/data/merged_data_final.parquet'
+if not os.path.exists(input_path):
+    input_path = '/drive/MyDrive/論文/data/data_final.csv'
+df = load_csv_and_record_rows(input_path)
 
 print("\n===== STEP 2: Convert PRC Negative =====")
 df = convert_prc_to_positive(df)
@@ -221,7 +283,8 @@ results = process_all_periods()
 
 print("\n===== STEP 6: Monthly Summary =====")
 for p in [1, 3, 6, 9, 12]:
-    summary = calculate_monthly_data_counts(pd.read_csv(f'/drive/MyDrive/論文/data/final_result_{p}m.csv'))
+    # 直接用 Step 5 留在記憶體的連續資料（與剛寫出的 final_result_{p}m 相同），不再重讀檔案
+    summary = calculate_monthly_data_counts(results[p][0])
     print(f"\n📊 {p}m monthly counts")
     print(summary)
 